@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
 
+import aiohttp
+import asyncio
 import datetime
+import hashlib
 import json
 import logging
-import requests
+from functools import lru_cache, partial
 from sanic import Blueprint, response
 from sanic.request import Request
-from typing import Text, Dict, Any, List, Iterable
+from typing import Text, Dict, Any, List, Iterable, Optional, Tuple
+from urllib.parse import urlencode
 
 from rasa.core.channels.channel import UserMessage, OutputChannel, InputChannel
+from rasa.utils.common import class_from_module_path
+
+try:
+    # sanic already installs `ujson` on the platforms supporting it
+    from ujson import dumps as json_dumps
+except ImportError:
+    json_dumps = partial(json.dumps, separators=(",", ":"))
 
 logger = logging.getLogger(__name__)
 
@@ -16,18 +27,219 @@ MICROSOFT_OAUTH2_URL = "https://login.microsoftonline.com"
 
 MICROSOFT_OAUTH2_PATH = "botframework.com/oauth2/v2.0/token"
 
+TOKEN_URI = "{}/{}".format(MICROSOFT_OAUTH2_URL, MICROSOFT_OAUTH2_PATH)
+
+BOTFRAMEWORK_SCOPE = "https://api.botframework.com/.default"
+
+# how often to check the token store while another process fetches a token
+TOKEN_STORE_POLL_RETRIES = 10
+
+TOKEN_STORE_POLL_INTERVAL = 0.2  # seconds
+
+
+@lru_cache(maxsize=16)
+def _token_payload(app_id: Text, app_password: Text) -> bytes:
+    """Form encoded body of the token request, the same for every refresh."""
+
+    return urlencode(
+        {
+            "client_id": app_id,
+            "client_secret": app_password,
+            "grant_type": "client_credentials",
+            "scope": BOTFRAMEWORK_SCOPE,
+        }
+    ).encode("utf-8")
+
+
+class TokenStore(object):
+    """Shares Bot Framework access tokens between processes.
+
+    Without a token store every process fetches its own token."""
+
+    @staticmethod
+    def create(config: Optional[Dict[Text, Any]]) -> Optional["TokenStore"]:
+        """Create a token store from the `token_store` credentials section."""
+
+        if not config:
+            return None
+
+        config = dict(config)
+        store_type = config.pop("type", None)
+        if store_type == "redis":
+            return RedisTokenStore(host=config.pop("url", "localhost"), **config)
+
+        store_class = None
+        if store_type:
+            try:
+                store_class = class_from_module_path(store_type)
+            except (AttributeError, ImportError):
+                pass
+
+        if store_class is None:
+            logger.warning(
+                "Token store type '%s' not found. "
+                "Tokens won't be shared between processes.",
+                store_type,
+            )
+            return None
+
+        return store_class(**config)
+
+    async def get(self, key: Text) -> Optional[Tuple[Text, int]]:
+        """Return a stored token and the seconds it stays valid for."""
+
+        raise NotImplementedError
+
+    async def set(self, key: Text, token: Text, ttl: int) -> None:
+        """Store a token for `ttl` seconds."""
+
+        raise NotImplementedError
+
+    async def delete(self, key: Text) -> None:
+        """Remove a token which got rejected by the Bot Framework."""
+
+        raise NotImplementedError
+
+    async def acquire_refresh_lock(self, key: Text) -> bool:
+        """Make sure only a single process fetches a new token."""
+
+        return True
+
+    async def release_refresh_lock(self, key: Text) -> None:
+        pass
+
+
+class RedisTokenStore(TokenStore):
+    def __init__(
+        self,
+        host: Text = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        password: Optional[Text] = None,
+        lock_timeout: int = 10,
+        socket_timeout: float = 1,
+    ) -> None:
+        import redis
+
+        # the redis client is blocking, an unreachable server must not stall
+        # the event loop for long
+        self.red = redis.StrictRedis(
+            host=host,
+            port=port,
+            db=db,
+            password=password,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_timeout,
+        )
+        self.lock_timeout = lock_timeout
+
+    async def get(self, key: Text) -> Optional[Tuple[Text, int]]:
+        token, ttl = self.red.pipeline().get(key).ttl(key).execute()
+        if token is None or ttl is None or ttl <= 0:
+            return None
+        return token.decode("utf-8"), ttl
+
+    async def set(self, key: Text, token: Text, ttl: int) -> None:
+        if ttl > 0:
+            self.red.setex(key, ttl, token)
+
+    async def delete(self, key: Text) -> None:
+        self.red.delete(key)
+
+    async def acquire_refresh_lock(self, key: Text) -> bool:
+        return bool(self.red.set(key + ":lock", 1, nx=True, ex=self.lock_timeout))
+
+    async def release_refresh_lock(self, key: Text) -> None:
+        self.red.delete(key + ":lock")
+
 
 class BotFramework(OutputChannel):
     """A Microsoft Bot Framework communication channel."""
 
-    token_expiration_date = datetime.datetime.now()
+    # an output channel is created for every incoming message
+    __slots__ = (
+        "app_id",
+        "app_password",
+        "conversation",
+        "global_uri",
+        "post_message_uri",
+        "bot",
+        "token_store",
+        "_msg_template",
+    )
+
+    token_expiration_date = datetime.datetime.utcnow()
 
     headers = None
 
+    # refresh the token a bit before it actually expires, so that it is
+    # still valid when it reaches the Bot Framework
+    _LEEWAY = datetime.timedelta(seconds=60)
+
+    _token_lock = None  # type: Optional[asyncio.Lock]
+
+    _token_lock_loop = None  # type: Optional[asyncio.AbstractEventLoop]
+
+    # refreshes the token in the background before it expires
+    _refresh_task = None  # type: Optional[asyncio.Future]
+
+    # send the messages of a multi part response concurrently. The Bot
+    # Framework does not guarantee that concurrently posted activities are
+    # displayed in order, hence this is disabled by default.
+    PARALLEL_SEND = False
+
+    # shared between all instances, as a new output channel is created
+    # for every incoming message
+    _session = None  # type: Optional[aiohttp.ClientSession]
+
     @classmethod
     def name(cls):
         return "botframework"
 
+    @classmethod
+    def _get_session(cls) -> aiohttp.ClientSession:
+        if cls._session is None or cls._session.closed:
+            # keep connections to the Bot Framework alive, so that consecutive
+            # messages don't have to go through the TLS handshake again
+            connector = aiohttp.TCPConnector(
+                limit=100, ttl_dns_cache=300, keepalive_timeout=75
+            )
+            cls._session = aiohttp.ClientSession(connector=connector)
+        return cls._session
+
+    @classmethod
+    def _get_token_lock(cls) -> asyncio.Lock:
+        # before Python 3.8 a lock is bound to the loop it was created in,
+        # hence a new one is needed whenever we run in a different loop
+        loop = asyncio.get_event_loop()
+        if cls._token_lock is None or cls._token_lock_loop is not loop:
+            cls._token_lock = asyncio.Lock()
+            cls._token_lock_loop = loop
+        return cls._token_lock
+
+    @classmethod
+    def _has_valid_token(cls) -> bool:
+        return (
+            cls.headers is not None
+            and cls.token_expiration_date - cls._LEEWAY > datetime.datetime.utcnow()
+        )
+
+    @classmethod
+    async def close_session(cls) -> None:
+        """Stop refreshing the token and close the HTTP session used to talk
+        to the Bot Framework."""
+
+        if cls._refresh_task is not None:
+            cls._refresh_task.cancel()
+            cls._refresh_task = None
+
+        cls._token_lock = None
+        cls._token_lock_loop = None
+
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+        cls._session = None
+
     def __init__(
         self,
         app_id: Text,
@@ -35,81 +247,234 @@ class BotFramework(OutputChannel):
         conversation: Dict[Text, Any],
         bot: Text,
         service_url: Text,
+        token_store: Optional[TokenStore] = None,
     ) -> None:
 
         self.app_id = app_id
         self.app_password = app_password
         self.conversation = conversation
         self.global_uri = "{}v3/".format(service_url)
+        self.post_message_uri = "{}conversations/{}/activities".format(
+            self.global_uri, conversation["id"]
+        )
         self.bot = bot
+        self.token_store = token_store
+        # the nested `channelData` is shared between all messages and must
+        # not be modified
+        self._msg_template = {
+            "type": "message",
+            "from": bot,
+            "channelData": {"notification": {"alert": "true"}},
+            "text": "",
+        }
+
+    async def _get_headers(self) -> Optional[Dict[Text, Any]]:
+        if BotFramework._has_valid_token():
+            return BotFramework.headers
+
+        return await self._refresh_token()
+
+    async def _refresh_token(self, force: bool = False) -> Optional[Dict[Text, Any]]:
+        async with BotFramework._get_token_lock():
+            # another coroutine might have refreshed the token while we
+            # were waiting for the lock
+            if not force and BotFramework._has_valid_token():
+                return BotFramework.headers
+
+            if self.token_store:
+                token = await self._get_shared_token(force)
+            else:
+                token = await self._fetch_token()
 
-    async def _get_headers(self):
-        if BotFramework.token_expiration_date < datetime.datetime.now():
-            uri = "{}/{}".format(MICROSOFT_OAUTH2_URL, MICROSOFT_OAUTH2_PATH)
-            grant_type = "client_credentials"
-            scope = "https://api.botframework.com/.default"
-            payload = {
-                "client_id": self.app_id,
-                "client_secret": self.app_password,
-                "grant_type": grant_type,
-                "scope": scope,
-            }
-
-            token_response = requests.post(uri, data=payload)
-
-            if token_response.ok:
-                token_data = token_response.json()
-                access_token = token_data["access_token"]
-                token_expiration = token_data["expires_in"]
+            if token:
+                access_token, token_expiration = token
 
                 delta = datetime.timedelta(seconds=int(token_expiration))
-                BotFramework.token_expiration_date = datetime.datetime.now() + delta
+                BotFramework.token_expiration_date = datetime.datetime.utcnow() + delta
 
                 BotFramework.headers = {
                     "content-type": "application/json",
                     "Authorization": "Bearer %s" % access_token,
                 }
+
+                task = BotFramework._refresh_task
+                if task is None or task.done():
+                    BotFramework._refresh_task = asyncio.ensure_future(
+                        self._keep_token_fresh()
+                    )
                 return BotFramework.headers
             else:
                 logger.error("Could not get BotFramework token")
-        else:
-            return BotFramework.headers
+
+    async def _keep_token_fresh(self) -> None:
+        """Refresh the token before it expires, so that sending a message
+        doesn't have to wait for it."""
+
+        while True:
+            # refresh before `_get_headers` considers the token to be expired
+            refresh_at = BotFramework.token_expiration_date - 2 * self._LEEWAY
+            delay = (refresh_at - datetime.datetime.utcnow()).total_seconds()
+            if delay <= 0:
+                # fall back to refreshing the token when it's needed
+                return
+
+            await asyncio.sleep(delay)
+            try:
+                headers = await self._refresh_token(force=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Failed to refresh the BotFramework token. %s", e)
+                logger.debug(e, exc_info=True)
+                return
+
+            if not headers:
+                return
+
+    async def _fetch_token(self) -> Optional[Tuple[Text, int]]:
+        session = self._get_session()
+        async with session.post(
+            TOKEN_URI,
+            data=_token_payload(self.app_id, self.app_password),
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        ) as token_response:
+            if token_response.status != 200:
+                return None
+            token_data = await token_response.json()
+
+        return token_data["access_token"], int(token_data["expires_in"])
+
+    def _token_key(self) -> Text:
+        # hash the key so the app id doesn't show up in the store
+        return hashlib.sha256(
+            "{}|{}".format(self.app_id, BOTFRAMEWORK_SCOPE).encode("utf-8")
+        ).hexdigest()
+
+    async def _get_shared_token(
+        self, force: bool = False
+    ) -> Optional[Tuple[Text, int]]:
+        key = self._token_key()
+        leeway = int(self._LEEWAY.total_seconds())
+
+        # a forced refresh replaces the current token, so it must not be read
+        # back from the store. A newer token which another process stored
+        # can be used though.
+        stale_authorization = None
+        if force and BotFramework.headers:
+            stale_authorization = BotFramework.headers.get("Authorization")
+
+        # the token store is only needed to share tokens, so replies
+        # shouldn't fail if it's unavailable. Errors while fetching the token
+        # itself are not caught here.
+        locked = False
+        try:
+            for _ in range(TOKEN_STORE_POLL_RETRIES):
+                stored = await self.token_store.get(key)
+
+                if stored and "Bearer %s" % stored[0] != stale_authorization:
+                    # tokens are stored without the leeway, add it back as it
+                    # is subtracted again when checking the expiration date
+                    token, ttl = stored
+                    return token, ttl + leeway
+
+                locked = await self.token_store.acquire_refresh_lock(key)
+                if locked:
+                    break
+
+                # another process is fetching a token, wait for it to be stored
+                await asyncio.sleep(TOKEN_STORE_POLL_INTERVAL)
+        except asyncio.CancelledError:
+            # not a store error, before Python 3.8 this is an `Exception`
+            raise
+        except Exception as e:
+            self._log_token_store_error(e)
+            return await self._fetch_token()
+
+        if not locked:
+            return await self._fetch_token()
+
+        try:
+            token = await self._fetch_token()
+            if token:
+                try:
+                    await self.token_store.set(key, token[0], token[1] - leeway)
+                except Exception as e:
+                    self._log_token_store_error(e)
+            return token
+        finally:
+            try:
+                await self.token_store.release_refresh_lock(key)
+            except Exception as e:
+                self._log_token_store_error(e)
+
+    @staticmethod
+    def _log_token_store_error(e: Exception) -> None:
+        logger.warning("Failed to use the Bot Framework token store. %s", e)
+        logger.debug(e, exc_info=True)
 
     def prepare_message(
         self, recipient_id: Text, message_data: Dict[Text, Any]
     ) -> Dict[Text, Any]:
-        data = {
-            "type": "message",
-            "recipient": {"id": recipient_id},
-            "from": self.bot,
-            "channelData": {"notification": {"alert": "true"}},
-            "text": "",
-        }
-        data.update(message_data)
-        return data
+        return {**self._msg_template, "recipient": {"id": recipient_id}, **message_data}
+
+    async def _invalidate_token(self, headers: Dict[Text, Any]) -> None:
+        """Forget the token used in `headers` after it got rejected.
+
+        A token which was refreshed in the meantime is kept."""
+
+        if BotFramework.headers is headers:
+            BotFramework.headers = None
+        if self.token_store:
+            key = self._token_key()
+            try:
+                stored = await self.token_store.get(key)
+                if stored and "Bearer %s" % stored[0] == headers.get("Authorization"):
+                    await self.token_store.delete(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._log_token_store_error(e)
 
     async def send(self, message_data: Dict[Text, Any]) -> None:
-        post_message_uri = "{}conversations/{}/activities".format(
-            self.global_uri, self.conversation["id"]
-        )
-        headers = await self._get_headers()
-        send_response = requests.post(
-            post_message_uri, headers=headers, data=json.dumps(message_data)
-        )
+        session = self._get_session()
+        # serialize once, also if the request has to be retried
+        body = json_dumps(message_data).encode("utf-8")
+        for attempt in range(2):
+            headers = await self._get_headers()
+            async with session.post(
+                self.post_message_uri, headers=headers, data=body
+            ) as send_response:
+                if send_response.status == 401 and attempt == 0:
+                    # the token got rejected, e.g. because of clock skew
+                    # between us and the Bot Framework. Fetch a new one
+                    # and retry once.
+                    await self._invalidate_token(headers)
+                    continue
+
+                if send_response.status >= 400:
+                    logger.error(
+                        "Error trying to send botframework message. Response: %s",
+                        await send_response.text(),
+                    )
+                return
 
-        if not send_response.ok:
-            logger.error(
-                "Error trying to send botframework messge. Response: %s",
-                send_response.text,
-            )
+    async def _send_all(self, messages: List[Dict[Text, Any]]) -> None:
+        if self.PARALLEL_SEND:
+            await asyncio.gather(*[self.send(m) for m in messages])
+        else:
+            for message in messages:
+                await self.send(message)
 
     async def send_text_message(
         self, recipient_id: Text, text: Text, **kwargs: Any
     ) -> None:
-        for message_part in text.split("\n\n"):
-            text_message = {"text": message_part}
-            message = self.prepare_message(recipient_id, text_message)
-            await self.send(message)
+        messages = [
+            self.prepare_message(recipient_id, {"text": message_part})
+            for message_part in text.split("\n\n")
+            # don't send empty messages, e.g. for trailing line breaks
+            if message_part.strip()
+        ]
+        await self._send_all(messages)
 
     async def send_image_url(
         self, recipient_id: Text, image: Text, **kwargs: Any
@@ -142,28 +507,30 @@ class BotFramework(OutputChannel):
     async def send_elements(
         self, recipient_id: Text, elements: Iterable[Dict[Text, Any]], **kwargs: Any
     ) -> None:
-        for e in elements:
-            message = self.prepare_message(recipient_id, e)
-            await self.send(message)
+        messages = [self.prepare_message(recipient_id, e) for e in elements]
+        await self._send_all(messages)
 
     async def send_custom_json(
         self, recipient_id: Text, json_message: Dict[Text, Any], **kwargs: Any
     ) -> None:
-        # pytype: disable=attribute-error
-        json_message.setdefault("type", "message")
-        json_message.setdefault("recipient", {}).setdefault("id", recipient_id)
-        json_message.setdefault("from", self.bot)
-        json_message.setdefault("channelData", {}).setdefault(
-            "notification", {}
-        ).setdefault("alert", "true")
-        json_message.setdefault("text", "")
-        await self.send(json_message)
-        # pytype: enable=attribute-error
+        message = self.prepare_message(recipient_id, json_message)
+
+        # fill in nested defaults without modifying the passed message
+        if "recipient" in json_message:
+            message["recipient"] = {"id": recipient_id, **json_message["recipient"]}
+        if "channelData" in json_message:
+            channel_data = json_message["channelData"]
+            notification = {"alert": "true", **channel_data.get("notification", {})}
+            message["channelData"] = {**channel_data, "notification": notification}
+
+        await self.send(message)
 
 
 class BotFrameworkInput(InputChannel):
     """Bot Framework input channel implementation."""
 
+    __slots__ = ("app_id", "app_password", "token_store")
+
     @classmethod
     def name(cls):
         return "botframework"
@@ -173,23 +540,36 @@ class BotFrameworkInput(InputChannel):
         if not credentials:
             cls.raise_missing_credentials_exception()
 
-        return cls(credentials.get("app_id"), credentials.get("app_password"))
+        return cls(
+            credentials.get("app_id"),
+            credentials.get("app_password"),
+            TokenStore.create(credentials.get("token_store")),
+        )
 
-    def __init__(self, app_id: Text, app_password: Text) -> None:
+    def __init__(
+        self, app_id: Text, app_password: Text, token_store: Optional[TokenStore] = None
+    ) -> None:
         """Create a Bot Framework input channel.
 
         Args:
             app_id: Bot Framework's API id
             app_password: Bot Framework application secret
+            token_store: store to share access tokens between processes
         """
 
         self.app_id = app_id
         self.app_password = app_password
+        self.token_store = token_store
 
     def blueprint(self, on_new_message):
 
         botframework_webhook = Blueprint("botframework_webhook", __name__)
 
+        # noinspection PyUnusedLocal
+        @botframework_webhook.listener("after_server_stop")
+        async def close_session(app, loop):
+            await BotFramework.close_session()
+
         # noinspection PyUnusedLocal
         @botframework_webhook.route("/", methods=["GET"])
         async def health(request: Request):
@@ -199,45 +579,50 @@ class BotFrameworkInput(InputChannel):
         async def webhook(request: Request):
             postdata = request.json
 
-            try:
-                if postdata["type"] == "message":
-                    out_channel = BotFramework(
-                        self.app_id,
-                        self.app_password,
-                        postdata["conversation"],
-                        postdata["recipient"],
-                        postdata["serviceUrl"],
-                    )
+            if not isinstance(postdata, dict) or postdata.get("type") != "message":
+                # typing indicators, conversation updates etc. don't need
+                # to be handled
+                logger.info("Not received message type")
+                return response.raw(b"", status=204)
 
+            try:
+                out_channel = BotFramework(
+                    self.app_id,
+                    self.app_password,
+                    postdata["conversation"],
+                    postdata["recipient"],
+                    postdata["serviceUrl"],
+                    self.token_store,
+                )
+
+                if logger.isEnabledFor(logging.DEBUG):
                     logger.debug(json.dumps(postdata, indent=4, sort_keys=True))
-                    if postdata.get('attachments'):
-                        user_msg = UserMessage(
-                            text=(postdata['text'] if postdata.get('text') 
-                                  else ""),
-                            metadata={"attachments": postdata['attachments']},
-                            output_channel=out_channel,
-                            sender_id=postdata["from"]["id"],
-                            input_channel=self.name(),
-                        )
-                    elif postdata.get('text'):
-                        user_msg = UserMessage(
-                            postdata["text"],
-                            out_channel,
-                            postdata["from"]["id"],
-                            input_channel=self.name(),
-                        )
-                    else:
-                        user_msg = UserMessage(
-                            json.dumps(postdata["value"]),
-                            out_channel,
-                            postdata["from"]["id"],
-                            input_channel=self.name(),
-                        )
-                    await on_new_message(user_msg)
+                text = postdata.get("text")
+                attachments = postdata.get("attachments")
+                sender_id = postdata["from"]["id"]
+
+                if attachments:
+                    user_msg = UserMessage(
+                        text=text or "",
+                        metadata={"attachments": attachments},
+                        output_channel=out_channel,
+                        sender_id=sender_id,
+                        input_channel=self.name(),
+                    )
+                elif text:
+                    user_msg = UserMessage(
+                        text, out_channel, sender_id, input_channel=self.name()
+                    )
                 else:
-                    logger.info("Not received message type")
+                    user_msg = UserMessage(
+                        json.dumps(postdata["value"]),
+                        out_channel,
+                        sender_id,
+                        input_channel=self.name(),
+                    )
+                await on_new_message(user_msg)
             except Exception as e:
-                logger.error("Exception when trying to handle message.{0}".format(e))
+                logger.error("Exception when trying to handle message. %s", e)
                 logger.debug(e, exc_info=True)
                 pass
 
@@ -1,7 +1,10 @@
+import asyncio
+import datetime
 import json
 import logging
 from unittest.mock import patch, MagicMock
 
+import fakeredis
 import pytest
 import responses
 from aioresponses import aioresponses
@@ -9,6 +12,7 @@ from sanic import Sanic
 
 import rasa.core.run
 from rasa.core import utils
+from rasa.core.channels.botframework import RedisTokenStore
 from rasa.core.channels.channel import UserMessage
 from rasa.core.channels.telegram import TelegramOutput
 from rasa.utils.endpoints import EndpointConfig
@@ -23,6 +27,28 @@ MODEL_PATH = MOODBOT_MODEL_PATH
 logger = logging.getLogger(__name__)
 
 
+class MockRedisTokenStore(RedisTokenStore):
+    def __init__(self):
+        self.red = fakeredis.FakeStrictRedis()
+        self.lock_timeout = 10
+
+        # added in redis==3.3.0, but not yet in fakeredis
+        self.red.connection_pool.connection_class.health_check_interval = 0
+
+
+@pytest.fixture(autouse=True)
+def reset_botframework():
+    """Bot Framework tokens, locks and sessions are shared on the class."""
+    from rasa.core.channels.botframework import BotFramework
+
+    BotFramework.headers = None
+    BotFramework.token_expiration_date = datetime.datetime.utcnow()
+    BotFramework._token_lock = None
+    BotFramework._token_lock_loop = None
+    BotFramework._session = None
+    BotFramework._refresh_task = None
+
+
 def fake_sanic_run(*args, **kwargs):
     """Used to replace `run` method of a Sanic server to avoid hanging."""
     logger.info("Rabatnic: Take this and find Sanic! I want him here by supper time.")
@@ -409,6 +435,503 @@ async def test_callback_calls_endpoint():
         assert text["text"] == "Hi there!"
 
 
+async def test_botframework_sends_text_message():
+    from rasa.core.channels.botframework import BotFramework
+
+    activities_url = "https://example.com/v3/conversations/conv-id/activities"
+
+    with aioresponses() as mocked:
+        mocked.post(
+            "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token",
+            payload={"access_token": "token", "expires_in": 3600},
+        )
+        mocked.post(activities_url, repeat=True, payload={})
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+        )
+
+        await output.send_text_message("test-id", "Hi there!")
+        await BotFramework.close_session()
+
+        r = latest_request(mocked, "POST", activities_url)
+
+        assert r
+
+        message = json.loads(r[-1].kwargs["data"].decode("utf-8"))
+
+        assert message["type"] == "message"
+        assert message["recipient"] == {"id": "test-id"}
+        assert message["from"] == {"id": "bot"}
+        assert message["text"] == "Hi there!"
+        assert r[-1].kwargs["headers"]["Authorization"] == "Bearer token"
+
+
+async def test_botframework_sends_text_parts_in_parallel(monkeypatch):
+    from rasa.core.channels.botframework import BotFramework
+
+    monkeypatch.setattr(BotFramework, "PARALLEL_SEND", True)
+
+    activities_url = "https://example.com/v3/conversations/conv-id/activities"
+
+    with aioresponses() as mocked:
+        mocked.post(
+            "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token",
+            payload={"access_token": "token", "expires_in": 3600},
+        )
+        mocked.post(activities_url, repeat=True, payload={})
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+        )
+
+        await output.send_text_message("test-id", "One\n\nTwo\n\nThree")
+        await BotFramework.close_session()
+
+        r = latest_request(mocked, "POST", activities_url)
+        texts = {json.loads(c.kwargs["data"].decode("utf-8"))["text"] for c in r}
+
+        assert len(r) == 3
+        assert texts == {"One", "Two", "Three"}
+
+
+async def test_botframework_fetches_token_only_once():
+    from rasa.core.channels.botframework import BotFramework
+
+    token_url = "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token"
+
+    with aioresponses() as mocked:
+        mocked.post(
+            token_url,
+            repeat=True,
+            payload={"access_token": "token", "expires_in": 3600},
+        )
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+        )
+
+        headers = await asyncio.gather(*[output._get_headers() for _ in range(3)])
+        await BotFramework.close_session()
+
+        assert len(latest_request(mocked, "POST", token_url)) == 1
+        assert all(h["Authorization"] == "Bearer token" for h in headers)
+
+
+async def test_botframework_refreshes_token_in_background(monkeypatch):
+    from rasa.core.channels.botframework import BotFramework
+
+    # makes the token refresh 0.1 seconds after it was fetched
+    monkeypatch.setattr(BotFramework, "_LEEWAY", datetime.timedelta(seconds=0.45))
+
+    token_url = "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token"
+
+    with aioresponses() as mocked:
+        mocked.post(token_url, payload={"access_token": "first", "expires_in": 1})
+        mocked.post(token_url, payload={"access_token": "second", "expires_in": 3600})
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+        )
+
+        headers = await output._get_headers()
+        assert headers["Authorization"] == "Bearer first"
+
+        # only the background task can fetch the second token, as
+        # `_get_headers` isn't called while waiting
+        for _ in range(100):
+            if BotFramework.headers["Authorization"] == "Bearer second":
+                break
+            await asyncio.sleep(0.05)
+        await BotFramework.close_session()
+
+        assert len(latest_request(mocked, "POST", token_url)) == 2
+        assert BotFramework.headers["Authorization"] == "Bearer second"
+
+
+async def test_botframework_background_refresh_stops_on_errors(monkeypatch):
+    from aiohttp import ClientConnectionError
+    from rasa.core.channels.botframework import BotFramework
+
+    leeway = datetime.timedelta(seconds=0.05)
+    monkeypatch.setattr(BotFramework, "_LEEWAY", leeway)
+    # the refresh is due shortly
+    BotFramework.token_expiration_date = datetime.datetime.utcnow() + 3 * leeway
+
+    output = BotFramework(
+        "app-id",
+        "app-password",
+        {"id": "conv-id"},
+        {"id": "bot"},
+        "https://example.com/",
+    )
+
+    async def unreachable_token_endpoint(force=False):
+        raise ClientConnectionError("unreachable")
+
+    output._refresh_token = unreachable_token_endpoint
+
+    # must return instead of raising
+    await output._keep_token_fresh()
+
+
+async def test_botframework_forced_refresh_ignores_stored_token():
+    from rasa.core.channels.botframework import BotFramework
+
+    token_url = "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token"
+
+    with aioresponses() as mocked:
+        mocked.post(token_url, payload={"access_token": "first", "expires_in": 3600})
+        mocked.post(token_url, payload={"access_token": "second", "expires_in": 3600})
+        mocked.post(token_url, payload={"access_token": "third", "expires_in": 3600})
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+            token_store=MockRedisTokenStore(),
+        )
+
+        first_headers = await output._get_headers()
+        # the store still holds the first token, which is about to be replaced
+        headers = await output._refresh_token(force=True)
+        stored_token, _ = await output.token_store.get(output._token_key())
+
+        assert len(latest_request(mocked, "POST", token_url)) == 2
+        assert headers["Authorization"] == "Bearer second"
+        assert stored_token == "second"
+
+        # simulate another worker which still uses the first token, it should
+        # pick up the second token from the store instead of fetching a new one
+        BotFramework.headers = first_headers
+        headers = await output._refresh_token(force=True)
+        await BotFramework.close_session()
+
+        assert len(latest_request(mocked, "POST", token_url)) == 2
+        assert headers["Authorization"] == "Bearer second"
+
+
+def test_botframework_token_lock_is_bound_to_running_loop():
+    from rasa.core.channels.botframework import BotFramework
+
+    async def get_lock():
+        return BotFramework._get_token_lock()
+
+    locks = []
+    for _ in range(2):
+        loop = asyncio.new_event_loop()
+        locks.append(loop.run_until_complete(get_lock()))
+        locks.append(loop.run_until_complete(get_lock()))
+        loop.close()
+
+    assert locks[0] is locks[1]
+    assert locks[1] is not locks[2]
+    assert locks[2] is locks[3]
+
+
+async def test_botframework_retries_with_new_token_if_rejected():
+    from rasa.core.channels.botframework import BotFramework
+
+    token_url = "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token"
+    activities_url = "https://example.com/v3/conversations/conv-id/activities"
+
+    with aioresponses() as mocked:
+        mocked.post(token_url, payload={"access_token": "expired", "expires_in": 3600})
+        mocked.post(token_url, payload={"access_token": "token", "expires_in": 3600})
+        mocked.post(activities_url, status=401)
+        mocked.post(activities_url, payload={})
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+        )
+
+        await output.send_text_message("test-id", "Hi there!")
+        await BotFramework.close_session()
+
+        r = latest_request(mocked, "POST", activities_url)
+
+        assert len(r) == 2
+        assert r[-1].kwargs["headers"]["Authorization"] == "Bearer token"
+
+
+async def test_botframework_skips_empty_text_parts():
+    from rasa.core.channels.botframework import BotFramework
+
+    output = BotFramework(
+        "app-id",
+        "app-password",
+        {"id": "conv-id"},
+        {"id": "bot"},
+        "https://example.com/",
+    )
+    output._send_all = MagicMock(return_value=asyncio.sleep(0))
+
+    await output.send_text_message("test-id", "Hi there!\n\n \n\nBye!\n\n")
+
+    messages = output._send_all.call_args[0][0]
+
+    assert [m["text"] for m in messages] == ["Hi there!", "Bye!"]
+
+
+async def test_botframework_send_custom_json():
+    from rasa.core.channels.botframework import BotFramework
+
+    output = BotFramework(
+        "app-id",
+        "app-password",
+        {"id": "conv-id"},
+        {"id": "bot"},
+        "https://example.com/",
+    )
+    output.send = MagicMock(return_value=asyncio.sleep(0))
+
+    json_message = {
+        "recipient": {"name": "user"},
+        "channelData": {"notification": {}, "custom": "value"},
+    }
+    await output.send_custom_json("test-id", json_message)
+
+    message = output.send.call_args[0][0]
+
+    assert message["type"] == "message"
+    assert message["from"] == {"id": "bot"}
+    assert message["text"] == ""
+    assert message["recipient"] == {"id": "test-id", "name": "user"}
+    assert message["channelData"] == {
+        "notification": {"alert": "true"},
+        "custom": "value",
+    }
+    # the passed message must not be modified
+    assert json_message == {
+        "recipient": {"name": "user"},
+        "channelData": {"notification": {}, "custom": "value"},
+    }
+
+
+async def test_botframework_shares_token_through_token_store():
+    from rasa.core.channels.botframework import BotFramework
+
+    token_url = "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token"
+
+    with aioresponses() as mocked:
+        mocked.post(
+            token_url,
+            repeat=True,
+            payload={"access_token": "token", "expires_in": 3600},
+        )
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+            token_store=MockRedisTokenStore(),
+        )
+
+        await output._get_headers()
+
+        # simulate another process which didn't fetch a token yet
+        BotFramework.headers = None
+        headers = await output._get_headers()
+        await BotFramework.close_session()
+
+        assert len(latest_request(mocked, "POST", token_url)) == 1
+        assert headers["Authorization"] == "Bearer token"
+        assert BotFramework._has_valid_token()
+
+
+async def test_botframework_late_rejection_keeps_refreshed_token():
+    from rasa.core.channels.botframework import BotFramework
+
+    token_url = "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token"
+
+    with aioresponses() as mocked:
+        mocked.post(token_url, payload={"access_token": "old", "expires_in": 3600})
+        mocked.post(token_url, payload={"access_token": "new", "expires_in": 3600})
+
+        token_store = MockRedisTokenStore()
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+            token_store=token_store,
+        )
+
+        old_headers = await output._get_headers()
+        new_headers = await output._refresh_token(force=True)
+
+        # a request which was sent with the old token gets rejected
+        await output._invalidate_token(old_headers)
+        await BotFramework.close_session()
+
+        assert BotFramework.headers is new_headers
+        stored = await token_store.get(output._token_key())
+        assert stored[0] == "new"
+
+        await output._invalidate_token(new_headers)
+
+        assert BotFramework.headers is None
+        assert await token_store.get(output._token_key()) is None
+
+
+async def test_botframework_fetches_token_if_token_store_fails():
+    from redis.exceptions import ConnectionError
+    from rasa.core.channels.botframework import BotFramework
+
+    token_store = MockRedisTokenStore()
+    token_store.red = MagicMock()
+    token_store.red.pipeline.side_effect = ConnectionError("Redis is down")
+
+    token_url = "https://login.microsoftonline.com/botframework.com/oauth2/v2.0/token"
+
+    with aioresponses() as mocked:
+        mocked.post(token_url, payload={"access_token": "token", "expires_in": 3600})
+
+        output = BotFramework(
+            "app-id",
+            "app-password",
+            {"id": "conv-id"},
+            {"id": "bot"},
+            "https://example.com/",
+            token_store=token_store,
+        )
+
+        headers = await output._get_headers()
+        await BotFramework.close_session()
+
+        assert headers["Authorization"] == "Bearer token"
+
+
+async def test_botframework_token_endpoint_errors_are_not_store_errors():
+    from aiohttp import ClientConnectionError
+    from rasa.core.channels.botframework import BotFramework
+
+    output = BotFramework(
+        "app-id",
+        "app-password",
+        {"id": "conv-id"},
+        {"id": "bot"},
+        "https://example.com/",
+        token_store=MockRedisTokenStore(),
+    )
+
+    fetches = []
+
+    async def unreachable_token_endpoint():
+        fetches.append(1)
+        raise ClientConnectionError("unreachable")
+
+    output._fetch_token = unreachable_token_endpoint
+
+    with pytest.raises(ClientConnectionError):
+        await output._get_headers()
+
+    assert len(fetches) == 1
+    # the refresh lock got released again
+    assert output.token_store.red.get(output._token_key() + ":lock") is None
+
+
+def test_botframework_token_store_from_credentials():
+    from rasa.core.channels.botframework import (
+        BotFrameworkInput,
+        RedisTokenStore,
+        TokenStore,
+    )
+
+    input_channel = BotFrameworkInput.from_credentials(
+        {
+            "app_id": "MICROSOFT_APP_ID",
+            "app_password": "MICROSOFT_APP_PASSWORD",
+            "token_store": {"type": "redis", "url": "localhost", "port": 6379},
+        }
+    )
+
+    assert isinstance(input_channel.token_store, RedisTokenStore)
+    assert TokenStore.create(None) is None
+    assert TokenStore.create({"type": "not.a.TokenStore"}) is None
+
+
+def test_botframework_webhook_handles_attachments():
+    from rasa.core.channels.botframework import BotFrameworkInput
+
+    input_channel = BotFrameworkInput(
+        app_id="MICROSOFT_APP_ID", app_password="MICROSOFT_APP_PASSWORD"
+    )
+    received_messages = []
+
+    async def on_new_message(message):
+        received_messages.append(message)
+
+    app = Sanic(__name__)
+    app.blueprint(
+        input_channel.blueprint(on_new_message), url_prefix="/webhooks/botframework"
+    )
+
+    attachments = [{"contentType": "image/png", "contentUrl": "https://example.com"}]
+    _, res = app.test_client.post(
+        "/webhooks/botframework/webhook",
+        json={
+            "type": "message",
+            "from": {"id": "user"},
+            "conversation": {"id": "conv-id"},
+            "recipient": {"id": "bot"},
+            "serviceUrl": "https://example.com/",
+            "attachments": attachments,
+        },
+    )
+
+    assert res.status == 200
+    assert len(received_messages) == 1
+    assert received_messages[0].text == ""
+    assert received_messages[0].sender_id == "user"
+    assert received_messages[0].metadata == {"attachments": attachments}
+
+
+@pytest.mark.parametrize("body", [{"type": "typing"}, [1], "message"])
+def test_botframework_ignores_non_message_activities(body):
+    from rasa.core.channels.botframework import BotFrameworkInput
+
+    input_channel = BotFrameworkInput(
+        app_id="MICROSOFT_APP_ID", app_password="MICROSOFT_APP_PASSWORD"
+    )
+    on_new_message = MagicMock()
+
+    app = Sanic(__name__)
+    app.blueprint(
+        input_channel.blueprint(on_new_message), url_prefix="/webhooks/botframework"
+    )
+
+    _, res = app.test_client.post("/webhooks/botframework/webhook", json=body)
+
+    assert res.status == 204
+    on_new_message.assert_not_called()
+
+
 def test_slack_message_sanitization():
     from rasa.core.channels.slack import SlackInput
 